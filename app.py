@@ -3,17 +3,26 @@ from config import Config
 from models import db, User, Asset, Transaction
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import OperationalError
 import requests
 import time
 from datetime import datetime
-import json
 import os
+import logging
 import random
 
+import coins as registry
+from deposits import DepositAddressBook
+import reconcile
+import valuation
+from price_store import PriceCachePersister
+from journal import BalanceJournal, bootstrap as journal_bootstrap
+
 from flask_socketio import SocketIO, emit
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.logger.setLevel(logging.INFO)
 
 db.init_app(app)
 
@@ -26,44 +35,94 @@ socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
 
 # simple in-memory price cache to reduce API calls
 _PRICE_CACHE_PATH = os.path.join(app.instance_path, "price_cache.json")
-_price_cache = {"ts": 0.0, "prices": {}}
+_price_cache = {"ts": 0.0, "prices": {}, "fx": {}}
 _PRICE_TTL_SECONDS = 30
+_PRICE_FLUSH_SECONDS = 10
 _markets_cache = {"ts": 0.0, "data": []}
 _MARKETS_TTL_SECONDS = 30
-_DEFAULT_PRICE_MAP = {
-    "USDT": 1.0,
-    "USDC": 1.0,
-    "CAD": 1.0,
-    "BTC": 43000.0,
-    "ETH": 2300.0,
-    "SOL": 100.0,
-    "XRP": 0.55,
-    "BNB": 600.0,
-    "LTC": 85.0,
-    "DOGE": 0.12,
-    "TRX": 0.12,
-}
+_DEFAULT_PRICE_MAP = registry.fallback_prices()
+# distinct coins held across all users (refresher's fetch set)
+_held_coins_cache = {"ts": 0.0, "coins": []}
+_HELD_COINS_TTL_SECONDS = 60
+
+def _price_cache_snapshot():
+    return {"ts": _price_cache["ts"], "prices": dict(_price_cache["prices"]), "fx": dict(_price_cache["fx"])}
+
+# write-behind: refreshes mark the cache dirty, at most one atomic write per interval
+_price_persister = PriceCachePersister(_PRICE_CACHE_PATH, _price_cache_snapshot, _PRICE_FLUSH_SECONDS)
 
 def _load_price_cache():
-    try:
-        if os.path.exists(_PRICE_CACHE_PATH):
-            with open(_PRICE_CACHE_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    _price_cache["ts"] = float(data.get("ts") or 0.0)
-                    _price_cache["prices"] = dict(data.get("prices") or {})
-    except Exception:
-        pass
+    data, age = _price_persister.load()
+    if data is None:
+        if age != "missing":
+            app.logger.warning("price cache snapshot ignored: %s", age)
+        return
+    _price_cache["ts"] = float(data.get("ts") or 0.0)
+    _price_cache["prices"] = dict(data.get("prices") or {})
+    _price_cache["fx"] = dict(data.get("fx") or {})
+    app.logger.info("price cache loaded: %d prices, %.0fs old", len(_price_cache["prices"]), age)
 
-def _save_price_cache():
+_load_price_cache()
+
+# all balance changes go through the append-only journal (group commit)
+journal = BalanceJournal(app)
+
+# per-user deposit addresses (pools + reverse index, loaded lazily)
+deposit_book = DepositAddressBook(app.config["DEPOSIT_ADDRESS_SEED"], app.config["DEPOSIT_POOL_SIZE"])
+
+def _held_symbols():
+    """
+    Distinct coins held by any user. Cached so the refresher doesn't run
+    SELECT DISTINCT on every tick. Needs an app context.
+    """
+    now = time.time()
+    if (now - _held_coins_cache["ts"]) < _HELD_COINS_TTL_SECONDS and _held_coins_cache["ts"]:
+        return _held_coins_cache["coins"]
     try:
-        os.makedirs(app.instance_path, exist_ok=True)
-        with open(_PRICE_CACHE_PATH, "w", encoding="utf-8") as f:
-            json.dump({"ts": _price_cache["ts"], "prices": _price_cache["prices"]}, f)
+        rows = db.session.query(Asset.coin).distinct().all()
+        _held_coins_cache["coins"] = sorted({(r[0] or "").upper() for r in rows if r[0]})
+        _held_coins_cache["ts"] = now
     except Exception:
         pass
+    return _held_coins_cache["coins"]
 
-_load_price_cache()
+def _fetch_prices(symbols):
+    """
+    Fetch prices for `symbols` from CoinGecko in as few /simple/price calls
+    as possible (ids chunked by registry.UPSTREAM_BATCH_SIZE), quoted in
+    every registry.QUOTE_CURRENCIES at once.
+    Returns ({symbol: usd price}, {quote: usd per unit}).
+    """
+    url = "https://api.coingecko.com/api/v3/simple/price"
+    vs = ",".join(q.lower() for q in registry.QUOTE_CURRENCIES)
+    quotes = {}
+    for batch in registry.upstream_batches(symbols):
+        try:
+            res = requests.get(url, params={"ids": ",".join(batch), "vs_currencies": vs}, timeout=10)
+            data = res.json() if res.ok else {}
+        except Exception:
+            continue
+        for cid, row in (data or {}).items():
+            coin = registry.by_cg_id(cid)
+            if coin and (row or {}).get("usd"):
+                quotes[coin.symbol] = row
+    prices = {sym: float(row["usd"]) for sym, row in quotes.items()}
+    return prices, valuation.quote_rates_from_quotes(quotes)
+
+def _refresh_prices(extra=()):
+    """
+    Refresh the price cache for every held coin plus the dashboard tickers
+    (and any `extra` symbols not yet in the held-coins cache).
+    Needs an app context.
+    """
+    wanted = set(_held_symbols()) | set(registry.TICKER_SYMBOLS) | set(extra)
+    fresh, fx = _fetch_prices(wanted)
+    if fresh:
+        _price_cache["prices"].update(fresh)
+        _price_cache["fx"].update(fx)
+        _price_cache["ts"] = time.time()
+        _price_persister.mark_dirty()
+    return fresh
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -176,12 +235,34 @@ def logout():
 # -----------------------------
 # Markets
 # -----------------------------
+def _quote_markets(rows, quote):
+    """
+    Markets are fetched and cached in USD only; other quotes are converted
+    with the cached FX rates (no extra upstream call).
+    """
+    if quote == "USD":
+        return rows
+    inv = 1.0 / valuation.get_matrix(_price_cache).quote_usd[quote]
+    out = []
+    for row in rows:
+        row = dict(row)
+        for field in ("current_price", "high_24h", "low_24h"):
+            if row.get(field) is not None:
+                row[field] = float(row[field]) * inv
+        out.append(row)
+    return out
+
+
 @app.route("/api/markets")
 def get_markets_api():
+    quote = (request.args.get("quote") or "USD").upper().strip()
+    if quote not in registry.QUOTE_CURRENCIES:
+        return jsonify({"success": False, "message": f"Unsupported quote currency {quote}."}), 400
+
     now = time.time()
     cache_fresh = (now - _markets_cache["ts"]) < _MARKETS_TTL_SECONDS
     if cache_fresh and _markets_cache["data"]:
-        return jsonify(_markets_cache["data"])
+        return jsonify(_quote_markets(_markets_cache["data"], quote))
 
     try:
         url = "https://api.coingecko.com/api/v3/coins/markets"
@@ -204,10 +285,10 @@ def get_markets_api():
             _markets_cache["data"] = coins
             _markets_cache["ts"] = now
         elif _markets_cache["data"]:
-            return jsonify(_markets_cache["data"])
+            return jsonify(_quote_markets(_markets_cache["data"], quote))
         else:
             fallback = []
-            for sym in ("BTC", "ETH", "SOL", "XRP", "BNB"):
+            for sym in registry.MARKETS_FALLBACK_SYMBOLS:
                 price = _price_cache["prices"].get(sym) or _DEFAULT_PRICE_MAP.get(sym)
                 fallback.append({
                     "id": sym.lower(),
@@ -218,13 +299,13 @@ def get_markets_api():
                     "high_24h": None,
                     "low_24h": None
                 })
-            return jsonify(fallback)
-        return jsonify(coins)
+            return jsonify(_quote_markets(fallback, quote))
+        return jsonify(_quote_markets(coins, quote))
     except Exception:
         if _markets_cache["data"]:
-            return jsonify(_markets_cache["data"])
+            return jsonify(_quote_markets(_markets_cache["data"], quote))
         fallback = []
-        for sym in ("BTC", "ETH", "SOL", "XRP", "BNB"):
+        for sym in registry.MARKETS_FALLBACK_SYMBOLS:
             price = _price_cache["prices"].get(sym) or _DEFAULT_PRICE_MAP.get(sym)
             fallback.append({
                 "id": sym.lower(),
@@ -235,7 +316,7 @@ def get_markets_api():
                 "high_24h": None,
                 "low_24h": None
             })
-        return jsonify(fallback)
+        return jsonify(_quote_markets(fallback, quote))
 
 
 # -----------------------------
@@ -246,77 +327,47 @@ def get_markets_api():
 def api_assets():
     rows = Asset.query.filter_by(user_id=current_user.id).all()
 
-    # Live price lookup via CoinGecko (no API key required)
-    symbol_to_id = {
-        "BTC": "bitcoin",
-        "ETH": "ethereum",
-        "SOL": "solana",
-        "XRP": "ripple",
-        "USDT": "tether",
-        "USDC": "usd-coin",
-        "BNB": "binancecoin",
-        "LTC": "litecoin",
-        "DOGE": "dogecoin",
-        "TRX": "tron",
-    }
+    quote = (request.args.get("quote") or "USD").upper().strip()
+    if quote not in registry.QUOTE_CURRENCIES:
+        return jsonify({"success": False, "message": f"Unsupported quote currency {quote}."}), 400
 
-    price_map = {}
-    ids = []
-    for r in rows:
-        sym = (r.coin or "").upper()
-        if sym in ("USD", "CAD"):
-            price_map[sym] = 1.0
-        elif sym in symbol_to_id:
-            ids.append(symbol_to_id[sym])
+    held = {r.coin.upper() for r in rows if registry.cg_id(r.coin)}
 
+    # Live price lookup via CoinGecko (no API key required)
     now = time.time()
     cache_fresh = (now - _price_cache["ts"]) < _PRICE_TTL_SECONDS
-    if _price_cache["prices"]:
-        price_map.update(_price_cache["prices"])
+    missing = held - set(_price_cache["prices"])
+    if held and (not cache_fresh or missing):
+        _refresh_prices(extra=held)
 
-    if ids and (not cache_fresh or not _price_cache["prices"]):
-        try:
-            url = "https://api.coingecko.com/api/v3/simple/price"
-            res = requests.get(url, params={"ids": ",".join(sorted(set(ids))), "vs_currencies": "usd"}, timeout=10)
-            data = res.json() if res.ok else {}
-            for sym, cid in symbol_to_id.items():
-                if cid in data and "usd" in data[cid]:
-                    price_map[sym] = float(data[cid]["usd"])
-            _price_cache["prices"] = {
-                k: v for k, v in price_map.items()
-                if k in symbol_to_id or k in ("USD", "CAD")
-            }
-            _price_cache["ts"] = now
-            _save_price_cache()
-        except Exception:
-            pass
-
-    # final fallback to avoid zero values when rate-limited
-    for r in rows:
-        sym = (r.coin or "").upper()
-        if sym not in price_map:
-            price_map[sym] = _DEFAULT_PRICE_MAP.get(sym, 0.0)
+    # falls back to registry prices/rates to avoid zero values when rate-limited
+    fx = valuation.get_matrix(_price_cache)
+    holdings = [(r.coin.upper(), float(r.amount)) for r in rows]
+    values, total = fx.value(holdings, quote)
+    values_usd, total_usd = fx.value(holdings, "USD") if quote != "USD" else (values, total)
 
     assets = []
-    total = 0.0
     available = 0.0
+    available_usd = 0.0
 
-    for r in rows:
-        px = float(price_map.get(r.coin.upper(), 0))
-        value = float(r.amount) * px
-        if r.coin.upper() in ("USDT", "USD", "USDC", "CAD"):
-            available += float(r.amount)
+    for (sym, amount), value, value_usd in zip(holdings, values, values_usd):
+        if sym in registry.CASH_SYMBOLS:
+            available += value
+            available_usd += value_usd
 
         assets.append({
-            "coin": r.coin.upper(),
-            "amount": float(r.amount),
-            "value_usd": round(value, 2)
+            "coin": sym,
+            "amount": amount,
+            "value": round(value, 2),
+            "value_usd": round(value_usd, 2)
         })
-        total += value
 
     return jsonify({
-        "available_usd": round(available, 2),
-        "total_usd": round(total, 2),
+        "quote": quote,
+        "available": round(available, 2),
+        "total": round(total, 2),
+        "available_usd": round(available_usd, 2),
+        "total_usd": round(total_usd, 2),
         "assets": assets
     })
 
@@ -370,10 +421,9 @@ def api_deposit_address():
     coin = (request.args.get("coin") or "USDT").upper().strip()
     network = (request.args.get("network") or "TRC20").upper().strip()
 
-    book = app.config.get("DEPOSIT_ADDRESSES", {})
-    addr = book.get(coin, {}).get(network)
+    addr = deposit_book.allocate(current_user.id, coin, network)
 
-    if not addr or "YOUR_" in addr:
+    if not addr:
         return jsonify({
             "success": False,
             "message": f"Deposit address not configured for {coin} on {network}."
@@ -437,25 +487,14 @@ def admin_set_asset():
     if not user:
         return jsonify({"success": False, "message": "User not found"}), 404
 
-    row = Asset.query.filter_by(user_id=user.id, coin=coin).first()
-    if not row:
-        row = Asset(user_id=user.id, coin=coin, amount=0.0)
-        db.session.add(row)
-
-    row.amount = amount
-    db.session.commit()
-
-    # log history as DEPOSIT
-    log_tx(
-        user_id=user.id,
-        tx_type="DEPOSIT",
-        coin=coin,
-        amount=amount,
-        status="CONFIRMED",
-        note=f"Admin set balance to {amount}"
-    )
+    # log history as DEPOSIT (same commit as the balance change)
+    res = journal.apply(user.id, coin, "SET", amount, log={
+        "type": "DEPOSIT",
+        "status": "CONFIRMED",
+        "note": f"Admin set balance to {amount}"
+    })
 
-    return jsonify({"success": True, "coin": coin, "amount": row.amount})
+    return jsonify({"success": True, "coin": coin, "amount": res["balance"]})
 
 
 @app.route("/api/admin/adjust_asset", methods=["POST"])
@@ -473,25 +512,14 @@ def admin_adjust_asset():
     if not user:
         return jsonify({"success": False, "message": "User not found"}), 404
 
-    row = Asset.query.filter_by(user_id=user.id, coin=coin).first()
-    if not row:
-        row = Asset(user_id=user.id, coin=coin, amount=0.0)
-        db.session.add(row)
-
-    row.amount = float(row.amount) + delta
-    db.session.commit()
-
-    # log history as DEPOSIT (amount = delta)
-    log_tx(
-        user_id=user.id,
-        tx_type="DEPOSIT",
-        coin=coin,
-        amount=delta,
-        status="CONFIRMED",
-        note="Admin adjusted balance"
-    )
+    # log history as DEPOSIT (amount = delta, same commit as the balance change)
+    res = journal.apply(user.id, coin, "ADJUST", delta, log={
+        "type": "DEPOSIT",
+        "status": "CONFIRMED",
+        "note": "Admin adjusted balance"
+    })
 
-    return jsonify({"success": True, "coin": coin, "new_amount": row.amount})
+    return jsonify({"success": True, "coin": coin, "new_amount": res["balance"]})
 
 
 # -----------------------------
@@ -506,26 +534,28 @@ def deposit_worker():
         try:
             with app.app_context():
                 pendings = Transaction.query.filter_by(status="PENDING").all()
-                for t in pendings:
-                    # simple simulated confirmations: after 15 seconds → confirm
-                    age = (now_utc() - t.created_at).total_seconds()
-                    if age >= 15:
-                        # credit user
-                        row = Asset.query.filter_by(user_id=t.user_id, coin=t.coin).first()
-                        if not row:
-                            row = Asset(user_id=t.user_id, coin=t.coin, amount=0.0)
-                            db.session.add(row)
-                        row.amount = float(row.amount) + float(t.amount)
-
-                        t.status = "CONFIRMED"
-                        t.note = (t.note or "") + " | Auto-confirmed"
-                        db.session.commit()
+                # simple simulated confirmations: after 15 seconds → confirm + credit user
+                # (all due deposits go through the journal as one group commit)
+                due = [
+                    journal.submit(t.user_id, t.coin, "ADJUST", t.amount, confirm_tx_id=t.id)
+                    for t in pendings
+                    if (now_utc() - t.created_at).total_seconds() >= 15
+                ]
+                for m in due:
+                    m.wait()
         except Exception:
             pass
 
         time.sleep(3)
 
 
+def _start_deposit_worker():
+    global _deposit_worker_started
+    if not _deposit_worker_started:
+        _deposit_worker_started = True
+        socketio.start_background_task(deposit_worker)
+
+
 @app.route("/api/admin/create_deposit", methods=["POST"])
 @login_required
 def admin_create_deposit():
@@ -562,14 +592,63 @@ def admin_create_deposit():
         network=network
     )
 
-    global _deposit_worker_started
-    if not _deposit_worker_started:
-        _deposit_worker_started = True
-        socketio.start_background_task(deposit_worker)
+    _start_deposit_worker()
 
     return jsonify({"success": True, "message": "Deposit created", "tx_id": t.id})
 
 
+@app.route("/api/admin/simulate_incoming", methods=["POST"])
+@login_required
+def admin_simulate_incoming():
+    """
+    Body: {"count": 1000}
+    Feeds `count` simulated on-chain payments to assigned deposit addresses
+    through the matcher. Matched payments become PENDING deposits.
+    Only available with DEPOSIT_SIMULATION_ENABLED (test databases).
+    """
+    if not is_admin():
+        return jsonify({"success": False, "message": "Forbidden"}), 403
+    if not app.config.get("DEPOSIT_SIMULATION_ENABLED"):
+        return jsonify({"success": False, "message": "Deposit simulation is disabled."}), 404
+
+    data = request.get_json() or {}
+    count = max(1, min(int(data.get("count") or 1000), 100000))
+
+    feed = deposit_book.simulate_feed(count)
+    started = time.perf_counter()
+    matched, unmatched = deposit_book.match_incoming(feed)
+    elapsed = time.perf_counter() - started
+
+    if matched:
+        _start_deposit_worker()
+
+    return jsonify({
+        "success": True,
+        "matched": matched,
+        "unmatched": unmatched,
+        "seconds": round(elapsed, 4),
+        "per_second": round(len(feed) / elapsed) if elapsed > 0 else None
+    })
+
+
+# -----------------------------
+# Ledger reconciliation (incremental, see reconcile.py)
+# -----------------------------
+@app.route("/api/admin/reconcile")
+@login_required
+def admin_reconcile():
+    if not is_admin():
+        return jsonify({"success": False, "message": "Forbidden"}), 403
+
+    try:
+        report = reconcile.run_incremental()
+    except OperationalError:
+        # another run holds the checkpoint lock past the busy timeout
+        db.session.rollback()
+        return jsonify({"success": False, "message": "Reconciliation already running"}), 409
+    return jsonify({"success": True, **report})
+
+
 # -----------------------------
 # /admin/assets (your existing form page) - keep it
 # ✅ CHANGE: log as DEPOSIT too
@@ -592,21 +671,14 @@ def admin_assets_page():
     if not user:
         return render_template("admin_assets.html", success=False, message="User not found.")
 
-    row = Asset.query.filter_by(user_id=user.id, coin=coin).first()
-    if not row:
-        row = Asset(user_id=user.id, coin=coin, amount=0.0)
-        db.session.add(row)
-
     if mode == "set":
-        row.amount = amount
-        db.session.commit()
-        log_tx(user.id, "DEPOSIT", coin, amount, "CONFIRMED", f"Admin set balance to {amount}")
-        return render_template("admin_assets.html", success=True, message=f"Set {username}'s {coin} to {row.amount}.")
+        res = journal.apply(user.id, coin, "SET", amount,
+                            log={"type": "DEPOSIT", "note": f"Admin set balance to {amount}"})
+        return render_template("admin_assets.html", success=True, message=f"Set {username}'s {coin} to {res['balance']}.")
     else:
-        row.amount = float(row.amount) + amount
-        db.session.commit()
-        log_tx(user.id, "DEPOSIT", coin, amount, "CONFIRMED", "Admin adjusted balance")
-        return render_template("admin_assets.html", success=True, message=f"Adjusted {username}'s {coin}. New balance: {row.amount}.")
+        res = journal.apply(user.id, coin, "ADJUST", amount,
+                            log={"type": "DEPOSIT", "note": "Admin adjusted balance"})
+        return render_template("admin_assets.html", success=True, message=f"Adjusted {username}'s {coin}. New balance: {res['balance']}.")
 
 
 # -----------------------------
@@ -615,43 +687,19 @@ def admin_assets_page():
 _streaming_started = False
 
 def price_streamer():
-    ids = ["bitcoin", "ethereum", "solana", "ripple"]
-    url = "https://api.coingecko.com/api/v3/simple/price"
-
     while True:
         try:
-            res = requests.get(
-                url,
-                params={"ids": ",".join(ids), "vs_currencies": "usd"},
-                timeout=10
-            )
-            data = res.json() if res.ok else {}
-
-            last = _price_cache.get("prices") or {}
-            prices = {
-                "BTC": float(data.get("bitcoin", {}).get("usd") or 0.0),
-                "ETH": float(data.get("ethereum", {}).get("usd") or 0.0),
-                "SOL": float(data.get("solana", {}).get("usd") or 0.0),
-                "XRP": float(data.get("ripple", {}).get("usd") or 0.0),
-            }
-            for sym in ("BTC", "ETH", "SOL", "XRP"):
-                if prices[sym] <= 0:
-                    prices[sym] = float(last.get(sym) or _DEFAULT_PRICE_MAP.get(sym, 0.0))
-
-            _price_cache["prices"].update(prices)
-            _price_cache["ts"] = time.time()
-            _save_price_cache()
-
-            socketio.emit("ticker_update", {**prices, "ts": int(time.time() * 1000)})
+            with app.app_context():
+                _refresh_prices()
         except Exception:
-            last = _price_cache.get("prices") or {}
-            prices = {
-                "BTC": float(last.get("BTC") or _DEFAULT_PRICE_MAP.get("BTC", 0.0)),
-                "ETH": float(last.get("ETH") or _DEFAULT_PRICE_MAP.get("ETH", 0.0)),
-                "SOL": float(last.get("SOL") or _DEFAULT_PRICE_MAP.get("SOL", 0.0)),
-                "XRP": float(last.get("XRP") or _DEFAULT_PRICE_MAP.get("XRP", 0.0)),
-            }
-            socketio.emit("ticker_update", {**prices, "ts": int(time.time() * 1000)})
+            pass
+
+        last = _price_cache.get("prices") or {}
+        prices = {
+            sym: float(last.get(sym) or _DEFAULT_PRICE_MAP.get(sym, 0.0))
+            for sym in registry.TICKER_SYMBOLS
+        }
+        socketio.emit("ticker_update", {**prices, "ts": int(time.time() * 1000)})
 
         socketio.sleep(1.5)
 
@@ -669,5 +717,7 @@ def on_connect():
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
+        deposit_book.ensure_pools()
+        journal_bootstrap()
 
     socketio.run(app, debug=True)
@@ -0,0 +1,98 @@
+"""
+Coin registry: the single place that knows which assets exist.
+
+Every symbol we hold, price or accept deposits for is listed here once,
+with its CoinGecko id (None for fiat), display decimals, deposit networks
+and a fallback USD price used when the upstream is unreachable.
+The registry is built once at import time and is read-only afterwards.
+"""
+
+# symbol -> (coingecko id, decimals, deposit networks, fallback usd price)
+_REGISTRY = {
+    "USDT": ("tether", 6, ("TRC20", "ERC20", "BEP20", "POLYGON", "ARBITRUM", "OPTIMISM", "SOL"), 1.0),
+    "USDC": ("usd-coin", 6, ("ERC20", "BEP20", "POLYGON", "ARBITRUM", "OPTIMISM", "SOL"), 1.0),
+    "CAD":  (None, 2, ("INTERAC", "SWIFT", "WIRE"), 0.73),
+    "BTC":  ("bitcoin", 8, ("BTC",), 43000.0),
+    "ETH":  ("ethereum", 18, ("ETH", "ARBITRUM", "OPTIMISM"), 2300.0),
+    "BNB":  ("binancecoin", 18, ("BEP20",), 600.0),
+    "SOL":  ("solana", 9, ("SOL",), 100.0),
+    "XRP":  ("ripple", 6, ("XRP",), 0.55),
+    "TRX":  ("tron", 6, ("TRC20",), 0.12),
+    "LTC":  ("litecoin", 8, ("LTC",), 85.0),
+    "DOGE": ("dogecoin", 8, ("DOGE",), 0.12),
+}
+
+# symbols always streamed to the dashboard tickers
+TICKER_SYMBOLS = ("BTC", "ETH", "SOL", "XRP")
+
+# symbols listed by /api/markets when CoinGecko is unreachable and nothing is cached
+MARKETS_FALLBACK_SYMBOLS = ("BTC", "ETH", "SOL", "XRP", "BNB")
+
+# symbols counted as spendable cash in "available"
+CASH_SYMBOLS = frozenset({"USD", "USDT", "USDC", "CAD"})
+
+# currencies portfolios and markets can be quoted in, with fallback USD per unit
+QUOTE_CURRENCIES = {
+    "USD": 1.0,
+    "CAD": 0.73,
+    "EUR": 1.08,
+}
+
+# CoinGecko /simple/price accepts long id lists; stay well under the URL limit
+UPSTREAM_BATCH_SIZE = 100
+
+
+class Coin:
+    __slots__ = ("symbol", "cg_id", "decimals", "networks", "fallback_price")
+
+    def __init__(self, symbol, cg_id, decimals, networks, fallback_price):
+        self.symbol = symbol
+        self.cg_id = cg_id
+        self.decimals = decimals
+        self.networks = networks
+        self.fallback_price = fallback_price
+
+    def __repr__(self):
+        return f"Coin({self.symbol!r}, {self.cg_id!r})"
+
+
+COINS = {
+    sym: Coin(sym, cg_id, decimals, networks, fallback)
+    for sym, (cg_id, decimals, networks, fallback) in _REGISTRY.items()
+}
+
+# reverse index for parsing upstream responses
+_BY_CG_ID = {c.cg_id: c for c in COINS.values() if c.cg_id}
+
+
+def get(symbol):
+    return COINS.get((symbol or "").upper())
+
+
+def by_cg_id(cg_id):
+    return _BY_CG_ID.get(cg_id)
+
+
+def cg_id(symbol):
+    c = get(symbol)
+    return c.cg_id if c else None
+
+
+def fallback_prices():
+    prices = {sym: c.fallback_price for sym, c in COINS.items()}
+    prices["USD"] = 1.0
+    return prices
+
+
+def networks(symbol):
+    c = get(symbol)
+    return c.networks if c else ()
+
+
+def upstream_batches(syms, size=UPSTREAM_BATCH_SIZE):
+    """
+    Map symbols to CoinGecko ids (skipping fiat/unknown), de-duplicated and
+    sorted, then split into chunks of at most `size` ids per request.
+    """
+    ids = sorted({c.cg_id for c in (get(s) for s in syms) if c and c.cg_id})
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
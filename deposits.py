@@ -0,0 +1,285 @@
+"""
+Per-user deposit addresses.
+
+Each (coin, network) has a pool of pre-generated addresses in the
+DepositAddress table. Addresses are derived deterministically from a seed
+and an index, so a pool can always be regenerated. A user gets one address
+per (coin, network) the first time they ask; the assignment is persisted on
+the row, and kept in memory in both directions:
+
+    _by_user[(user_id, coin, network)] -> address
+    _by_address[address]               -> (user_id, coin, network)
+
+Free addresses sit in a deque per (coin, network), so allocation is O(1).
+Everything here needs an app context.
+"""
+import hashlib
+import hmac
+import random
+import threading
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+import coins as registry
+from models import db, DepositAddress, IncomingPayment, Transaction
+
+# networks that use 0x-style account addresses
+_EVM_NETWORKS = frozenset({"ERC20", "BEP20", "POLYGON", "ARBITRUM", "OPTIMISM", "ETH"})
+_B58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def _b58(raw):
+    n = int.from_bytes(raw, "big")
+    out = ""
+    while n:
+        n, rem = divmod(n, 58)
+        out = _B58[rem] + out
+    return out
+
+
+def derive_address(seed, coin, network, idx):
+    """
+    Deterministic address for slot `idx` of (coin, network). Not a real
+    on-chain derivation, but stable and collision-free for our purposes.
+    """
+    msg = f"{coin}:{network}:{idx}".encode()
+    digest = hmac.new(seed.encode(), msg, hashlib.sha256).digest()
+    if network in _EVM_NETWORKS:
+        return "0x" + digest[:20].hex()
+    return _b58(digest[:25])
+
+
+class DepositAddressBook:
+    def __init__(self, seed, pool_size=100):
+        self.seed = seed
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._free = {}        # (coin, network) -> deque of DepositAddress ids
+        self._by_user = {}
+        self._by_address = {}
+
+    # -----------------------------
+    # Loading / pool management
+    # -----------------------------
+    def load(self):
+        """Build the in-memory indexes from the table (once per process)."""
+        with self._lock:
+            if self._loaded:
+                return
+            rows = db.session.query(
+                DepositAddress.id, DepositAddress.coin, DepositAddress.network,
+                DepositAddress.idx, DepositAddress.address, DepositAddress.user_id,
+            ).order_by(DepositAddress.idx.asc()).all()
+
+            for row_id, coin, network, _idx, address, user_id in rows:
+                if user_id is None:
+                    self._free.setdefault((coin, network), deque()).append(row_id)
+                else:
+                    self._remember(user_id, coin, network, address)
+            self._loaded = True
+
+    def _remember(self, user_id, coin, network, address):
+        self._by_user[(user_id, coin, network)] = address
+        self._by_address[address] = (user_id, coin, network)
+
+    def _top_up(self, coin, network):
+        """
+        Generate and insert the next `pool_size` addresses for (coin, network),
+        then reload that pool's free list. If another worker topped up at the
+        same time, its rows are used instead.
+        """
+        last = (
+            db.session.query(db.func.max(DepositAddress.idx))
+            .filter_by(coin=coin, network=network)
+            .scalar()
+        )
+        start = 0 if last is None else last + 1
+        rows = [
+            {"coin": coin, "network": network, "idx": i,
+             "address": derive_address(self.seed, coin, network, i)}
+            for i in range(start, start + self.pool_size)
+        ]
+        try:
+            db.session.bulk_insert_mappings(DepositAddress, rows)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+        free = (
+            db.session.query(DepositAddress.id)
+            .filter(DepositAddress.coin == coin, DepositAddress.network == network,
+                    DepositAddress.user_id.is_(None))
+            .order_by(DepositAddress.idx.asc())
+            .all()
+        )
+        self._free[(coin, network)] = deque(r[0] for r in free)
+
+    def ensure_pools(self):
+        """Make sure every registry coin/network has a non-empty free pool."""
+        self.load()
+        with self._lock:
+            for sym, coin in registry.COINS.items():
+                for network in coin.networks:
+                    if not self._free.get((sym, network)):
+                        self._top_up(sym, network)
+
+    # -----------------------------
+    # Allocation
+    # -----------------------------
+    def allocate(self, user_id, coin, network):
+        """
+        Return the user's address for (coin, network), assigning a free one
+        from the pool on first use. Returns None for unsupported pairs.
+        """
+        coin, network = coin.upper(), network.upper()
+        if network not in registry.networks(coin):
+            return None
+
+        self.load()
+        with self._lock:
+            addr = self._by_user.get((user_id, coin, network))
+            if addr:
+                return addr
+
+            # assigned by another worker since we loaded?
+            row = DepositAddress.query.filter_by(user_id=user_id, coin=coin, network=network).first()
+            if row:
+                self._remember(user_id, coin, network, row.address)
+                return row.address
+
+            key = (coin, network)
+            while True:
+                free = self._free.get(key)
+                if not free:
+                    self._top_up(coin, network)
+                    free = self._free[key]
+                row_id = free.popleft()
+
+                # guarded claim: another process may have taken this slot
+                try:
+                    res = db.session.execute(
+                        update(DepositAddress)
+                        .where(DepositAddress.id == row_id, DepositAddress.user_id.is_(None))
+                        .values(user_id=user_id, assigned_at=datetime.utcnow())
+                    )
+                    db.session.commit()
+                except IntegrityError:
+                    # another worker gave this user a (coin, network) address after
+                    # our check above; the slot we popped stays free for reuse
+                    db.session.rollback()
+                    free.appendleft(row_id)
+                    row = DepositAddress.query.filter_by(user_id=user_id, coin=coin, network=network).first()
+                    if not row:
+                        raise
+                    self._remember(user_id, coin, network, row.address)
+                    return row.address
+                if res.rowcount == 1:
+                    address = db.session.get(DepositAddress, row_id).address
+                    self._remember(user_id, coin, network, address)
+                    return address
+
+    # -----------------------------
+    # Incoming payments
+    # -----------------------------
+    def match_incoming(self, payments):
+        """
+        Turn incoming payments ({"address", "amount", "txid"?}) into PENDING
+        DEPOSIT transactions with a single bulk insert + commit.
+        Addresses missing from the reverse index (assigned by another worker)
+        are resolved with one IN query for the whole batch.
+        Payments whose txid was already recorded (re-delivered feed items) are
+        skipped; the txids are stored in IncomingPayment in the same commit.
+        Returns (matched, unmatched) counts; duplicates count as unmatched.
+        """
+        self.load()
+        payments = list(payments)
+        by_address = self._by_address
+
+        misses = {p.get("address") for p in payments if p.get("address") not in by_address}
+        misses.discard(None)
+        if misses:
+            found = (
+                DepositAddress.query
+                .filter(DepositAddress.address.in_(misses), DepositAddress.user_id.isnot(None))
+                .all()
+            )
+            for row in found:
+                self._remember(row.user_id, row.coin, row.network, row.address)
+
+        # a concurrent matcher may record the same txids first; retry once against its rows
+        for attempt in range(2):
+            txids = {p.get("txid") for p in payments if p.get("txid")}
+            seen = set()
+            if txids:
+                seen = {
+                    r[0] for r in db.session.query(IncomingPayment.txid)
+                    .filter(IncomingPayment.txid.in_(txids))
+                }
+
+            now = datetime.utcnow()
+            rows = []
+            receipts = []
+            unmatched = 0
+            for p in payments:
+                txid = p.get("txid")
+                hit = by_address.get(p.get("address"))
+                amount = float(p.get("amount") or 0)
+                if not hit or amount <= 0 or txid in seen:
+                    unmatched += 1
+                    continue
+                if txid:
+                    seen.add(txid)
+                    receipts.append({"txid": txid, "address": p["address"], "created_at": now})
+                user_id, coin, network = hit
+                rows.append({
+                    "user_id": user_id,
+                    "type": "DEPOSIT",
+                    "coin": coin,
+                    "amount": amount,
+                    "status": "PENDING",
+                    "note": f"Incoming {txid or ''}".strip(),
+                    "network": network,
+                    "created_at": now,
+                })
+
+            if not rows:
+                break
+            try:
+                db.session.bulk_insert_mappings(IncomingPayment, receipts)
+                db.session.bulk_insert_mappings(Transaction, rows)
+                db.session.commit()
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt:
+                    raise
+        return len(rows), unmatched
+
+    def simulate_feed(self, count, unknown_ratio=0.05):
+        """
+        Simulated chain feed: `count` payments to random assigned addresses,
+        with a few to addresses we don't know about. Each payment is worth
+        $5-$500 at the coin's registry fallback price, rounded to its decimals.
+        """
+        self.load()
+        known = list(self._by_address)
+        feed = []
+        for i in range(count):
+            usd = random.uniform(5, 500)
+            if not known or random.random() < unknown_ratio:
+                address = "unknown-" + hashlib.sha1(str(random.random()).encode()).hexdigest()[:20]
+                amount = round(usd, 2)
+            else:
+                address = random.choice(known)
+                coin = registry.get(self._by_address[address][1])
+                amount = round(usd / coin.fallback_price, min(coin.decimals, 8))
+            feed.append({
+                "address": address,
+                "amount": amount,
+                "txid": hashlib.sha256(f"{address}:{i}:{random.random()}".encode()).hexdigest()[:16],
+            })
+        return feed
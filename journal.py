@@ -0,0 +1,433 @@
+"""
+Append-only balance journal.
+
+Every balance change is a BalanceEvent. Asset rows are the projection of
+those events and are updated in the same commit, and BalanceSnapshot records
+the last event the projection reflects. Transaction history rows written
+with a mutation (or PENDING deposits it confirms) go into that same commit,
+so a mutation costs one fsync instead of two.
+
+Group commit: callers submit() mutations to a queue and wait. A single
+committer thread drains whatever is queued (up to max_batch), applies it in
+order and commits once, so N concurrent writers share one fsync. With
+group_commit=False each mutation commits on its own in the caller's thread,
+which is what the benchmark compares against.
+
+The first time the journal starts against a database with balances but no
+events, it writes one OPENING event per Asset row so replay starts from
+the existing balances.
+
+Usage:
+    python journal.py replay [-j 4] [--dry-run]   # rebuild Asset from the journal
+    python journal.py bench [-n 2000] [-t 16]     # group commit vs per-request commits
+"""
+import argparse
+import os
+import queue
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Asset, Transaction, BalanceEvent, BalanceSnapshot
+from partition import map_user_ranges
+
+KINDS = ("ADJUST", "SET", "OPENING")
+
+
+class _Mutation:
+    __slots__ = ("user_id", "coin", "kind", "amount", "log", "confirm_tx_id",
+                 "done", "result", "error")
+
+    def __init__(self, user_id, coin, kind, amount, log, confirm_tx_id):
+        self.user_id = user_id
+        self.coin = coin
+        self.kind = kind
+        self.amount = amount
+        self.log = log
+        self.confirm_tx_id = confirm_tx_id
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=30):
+        """Block until committed. Returns {"event_id", "balance", "tx_id"}, or None for a no-op confirm."""
+        if not self.done.wait(timeout):
+            raise TimeoutError("balance journal commit timed out")
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class BalanceJournal:
+    def __init__(self, app, group_commit=True, max_batch=500, max_wait=0.002):
+        self.app = app
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    # -----------------------------
+    # Public API
+    # -----------------------------
+    def submit(self, user_id, coin, kind, amount, log=None, confirm_tx_id=None):
+        """
+        Queue a balance mutation and return a handle to wait() on.
+
+        kind:          ADJUST (amount is a delta) or SET (amount is the new balance)
+        log:           Transaction fields to insert in the same commit
+                       (type, status, note, network)
+        confirm_tx_id: PENDING Transaction to mark CONFIRMED in the same commit;
+                       the mutation is skipped if it is no longer PENDING
+        """
+        kind = kind.upper()
+        if kind not in KINDS:
+            raise ValueError(f"unknown balance event kind {kind}")
+        m = _Mutation(user_id, coin.upper(), kind, float(amount), log, confirm_tx_id)
+        self._ensure_started()
+        if self.group_commit:
+            self._queue.put(m)
+        else:
+            self._commit([m])
+        return m
+
+    def apply(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).wait()
+
+    # -----------------------------
+    # Committer
+    # -----------------------------
+    def _ensure_started(self):
+        """
+        Bootstrap and start the committer once. Only marked started after
+        both succeed, so a failed bootstrap (locked database, missing
+        tables) is retried by the next submit() instead of leaving
+        mutations queued with no committer.
+        """
+        with self._lock:
+            if self._started:
+                return
+            with self.app.app_context():
+                bootstrap()
+            if self.group_commit:
+                threading.Thread(target=self._run, name="balance-journal", daemon=True).start()
+            self._started = True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            results = _apply_batch(batch)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].error = e
+                batch[0].done.set()
+                return
+            # isolate the failing mutation(s)
+            for m in batch:
+                self._commit([m])
+            return
+        for m, result in zip(batch, results):
+            m.result = result
+            m.done.set()
+
+
+def _lock_journal():
+    """
+    Take the journal's write lock until commit: a no-op UPDATE of the
+    snapshot row (SQLite's RESERVED lock, a row lock elsewhere).
+    """
+    db.session.execute(
+        update(BalanceSnapshot)
+        .where(BalanceSnapshot.id == 1)
+        .values(last_event_id=BalanceSnapshot.last_event_id)
+    )
+
+
+def _apply_batch(batch):
+    """
+    Apply mutations in order within the current session (no commit).
+
+    Committers in other processes write the same rows, so the batch first
+    takes the journal's write lock and only reads after that. Balance
+    changes are still applied as `amount = amount + delta` and
+    confirmations as a guarded PENDING -> CONFIRMED update, so neither
+    relies on a value read earlier.
+    """
+    _lock_journal()
+
+    keys = {(m.user_id, m.coin) for m in batch}
+    balances = {
+        (user_id, coin.upper()): float(amount)
+        for user_id, coin, amount in db.session.execute(
+            select(Asset.user_id, Asset.coin, Asset.amount).where(
+                Asset.user_id.in_({k[0] for k in keys}),
+                Asset.coin.in_({k[1] for k in keys}),
+            )
+        )
+    }
+
+    now = datetime.utcnow()
+    staged = []
+    for m in batch:
+        tx = None
+        if m.confirm_tx_id:
+            res = db.session.execute(
+                update(Transaction)
+                .where(Transaction.id == m.confirm_tx_id, Transaction.status == "PENDING")
+                .values(status="CONFIRMED",
+                        note=func.coalesce(Transaction.note, "") + " | Auto-confirmed")
+            )
+            if res.rowcount != 1:
+                # already confirmed (by another worker) or gone
+                staged.append(None)
+                continue
+
+        key = (m.user_id, m.coin)
+        current = balances.get(key)
+        delta = m.amount - (current or 0.0) if m.kind == "SET" else m.amount
+        if current is None:
+            db.session.execute(insert(Asset).values(user_id=m.user_id, coin=m.coin, amount=delta, updated_at=now))
+        else:
+            db.session.execute(
+                update(Asset)
+                .where(Asset.user_id == m.user_id, Asset.coin == m.coin)
+                .values(amount=Asset.amount + delta, updated_at=now)
+            )
+        balances[key] = (current or 0.0) + delta
+
+        if m.log:
+            network = m.log.get("network")
+            tx = Transaction(
+                user_id=m.user_id,
+                type=m.log.get("type", "DEPOSIT"),
+                coin=m.coin,
+                amount=float(m.log.get("amount", m.amount)),
+                status=m.log.get("status", "CONFIRMED"),
+                note=m.log.get("note") or "",
+                network=(network.upper() if network else None),
+                created_at=now,
+            )
+            db.session.add(tx)
+        staged.append((m, delta, balances[key], tx))
+
+    db.session.flush()   # Transaction ids for the events
+
+    events = []
+    for item in staged:
+        if item is None:
+            events.append(None)
+            continue
+        m, delta, balance, tx = item
+        tx_id = tx.id if tx else m.confirm_tx_id
+        ev = BalanceEvent(user_id=m.user_id, coin=m.coin, kind=m.kind, amount=m.amount,
+                          delta=delta, tx_id=tx_id, created_at=now)
+        db.session.add(ev)
+        events.append((ev, balance, tx_id))
+    db.session.flush()
+
+    written = [e[0] for e in events if e is not None]
+    if written:
+        db.session.execute(
+            update(BalanceSnapshot)
+            .where(BalanceSnapshot.id == 1)
+            .values(last_event_id=written[-1].id, updated_at=now)
+        )
+
+    return [
+        None if e is None else {"event_id": e[0].id, "balance": e[1], "tx_id": e[2]}
+        for e in events
+    ]
+
+
+def bootstrap():
+    """
+    Create the snapshot row, seeding the journal with an OPENING event per
+    existing Asset row. Idempotent and safe to race: the snapshot row's
+    primary key makes only one process win.
+    """
+    if db.session.get(BalanceSnapshot, 1):
+        return False
+    now = datetime.utcnow()
+    try:
+        db.session.add(BalanceSnapshot(id=1, last_event_id=0, updated_at=now))
+        db.session.flush()
+        if not db.session.query(BalanceEvent.id).first():
+            db.session.bulk_insert_mappings(BalanceEvent, [
+                {"user_id": user_id, "coin": coin.upper(), "kind": "OPENING",
+                 "amount": float(amount), "delta": float(amount), "created_at": now}
+                for user_id, coin, amount in db.session.query(Asset.user_id, Asset.coin, Asset.amount)
+            ])
+        last = db.session.query(func.max(BalanceEvent.id)).scalar() or 0
+        db.session.get(BalanceSnapshot, 1).last_event_id = last
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+# -----------------------------
+# Replay
+# -----------------------------
+def _replay_range(db_url, lo, hi, max_event_id):
+    """Worker: final balance per (user, coin) for user_id in [lo, hi)."""
+    engine = create_engine(db_url)
+    e = BalanceEvent.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(e.c.user_id, e.c.coin, func.sum(e.c.delta))
+            .where(e.c.user_id >= lo, e.c.user_id < hi, e.c.id <= max_event_id)
+            .group_by(e.c.user_id, e.c.coin)
+        ).all()
+    engine.dispose()
+    return [(u, c, float(s or 0)) for u, c, s in rows]
+
+
+def replay(workers=4, dry_run=False):
+    """
+    Rebuild every Asset balance from the journal, aggregating user-id
+    ranges in a process pool. Holds the journal's write lock from before
+    reading the high-water mark until it commits (or rolls back for a dry
+    run), so committers wait instead of appending events the rebuild
+    would miss.
+    Returns {"events", "balances", "changed": [(user_id, coin, old, new)]}.
+    """
+    bootstrap()
+    _lock_journal()
+    max_event_id = db.session.query(func.max(BalanceEvent.id)).scalar() or 0
+
+    balances = {}
+    if max_event_id:
+        for rows in map_user_ranges(BalanceEvent, _replay_range, max_event_id, workers=workers):
+            for user_id, coin, total in rows:
+                key = (user_id, coin.upper())
+                balances[key] = balances.get(key, 0.0) + total
+
+    changed = []
+    remaining = dict(balances)
+    for row in Asset.query.all():
+        key = (row.user_id, row.coin.upper())
+        new = remaining.pop(key, 0.0)
+        if abs(float(row.amount) - new) > 1e-12:
+            changed.append((row.user_id, key[1], float(row.amount), new))
+            row.amount = new
+    for (user_id, coin), new in remaining.items():
+        changed.append((user_id, coin, None, new))
+        db.session.add(Asset(user_id=user_id, coin=coin, amount=new))
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        snap = db.session.get(BalanceSnapshot, 1)
+        snap.last_event_id = max_event_id
+        snap.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    return {"events": max_event_id, "balances": len(balances), "changed": changed}
+
+
+# -----------------------------
+# Benchmark
+# -----------------------------
+def bench(mutations=2000, threads=16, users=50):
+    """
+    Mutations/sec for concurrent ADJUSTs (each also writing a Transaction
+    row), with group commit vs one commit per mutation, on a scratch SQLite
+    database.
+    """
+    from flask import Flask
+    from models import User
+
+    results = {}
+    for mode in ("per-request", "group"):
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_app = Flask("journal-bench")
+            bench_app.config.update(
+                SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(tmp, "bench.db"),
+                SQLALCHEMY_TRACK_MODIFICATIONS=False,
+            )
+            db.init_app(bench_app)
+            with bench_app.app_context():
+                db.create_all()
+                db.session.bulk_insert_mappings(User, [
+                    {"username": f"bench{i}", "firstname": "b", "lastname": "b",
+                     "email": f"bench{i}@example.com", "password": "x"}
+                    for i in range(users)
+                ])
+                db.session.commit()
+
+            journal = BalanceJournal(bench_app, group_commit=(mode == "group"))
+            per_thread = mutations // threads
+            errors = []
+
+            def writer(n):
+                with bench_app.app_context():
+                    for i in range(per_thread):
+                        try:
+                            journal.apply(1 + (n * per_thread + i) % users, "USDT", "ADJUST", 1.0,
+                                          log={"type": "DEPOSIT", "note": "bench"})
+                        except Exception as e:
+                            errors.append(e)
+
+            started = time.perf_counter()
+            pool = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            elapsed = time.perf_counter() - started
+
+            with bench_app.app_context():
+                total = db.session.query(func.sum(Asset.amount)).scalar() or 0
+                db.session.remove()
+                db.engine.dispose()
+
+            done = per_thread * threads - len(errors)
+            results[mode] = {"mutations": done, "errors": len(errors), "seconds": elapsed,
+                             "per_second": done / elapsed if elapsed else 0.0, "balance_total": total}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Balance journal tools.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_replay = sub.add_parser("replay", help="rebuild Asset balances from the journal")
+    p_replay.add_argument("-j", "--workers", type=int, default=4)
+    p_replay.add_argument("--dry-run", action="store_true", help="report differences without writing")
+    p_bench = sub.add_parser("bench", help="group commit vs per-request commit throughput")
+    p_bench.add_argument("-n", "--mutations", type=int, default=2000)
+    p_bench.add_argument("-t", "--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.cmd == "bench":
+        for mode, r in bench(args.mutations, args.threads).items():
+            print(f"{mode:12s} {r['mutations']:6d} mutations in {r['seconds']:.2f}s = "
+                  f"{r['per_second']:.0f}/s (errors={r['errors']})")
+    else:
+        from app import app
+
+        with app.app_context():
+            db.create_all()
+            report = replay(args.workers, args.dry_run)
+        for user_id, coin, old, new in report["changed"]:
+            print(f"user {user_id} {coin}: {old} -> {new}")
+        print(f"replayed {report['events']} events into {report['balances']} balances, "
+              f"{len(report['changed'])} changed{' (dry run)' if args.dry_run else ''}")
@@ -22,7 +22,7 @@ class Asset(db.Model):
 
     coin = db.Column(db.String(12), nullable=False)         # e.g. "USDT", "BTC"
     amount = db.Column(db.Float, nullable=False, default=0) # user's balance
-    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     __table_args__ = (
         db.UniqueConstraint("user_id", "coin", name="uq_user_coin"),
@@ -45,3 +45,70 @@ class Transaction(db.Model):
     network = db.Column(db.String(30), nullable=True)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class DepositAddress(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+
+    coin = db.Column(db.String(12), nullable=False)
+    network = db.Column(db.String(30), nullable=False)
+    idx = db.Column(db.Integer, nullable=False)                 # derivation index within (coin, network)
+    address = db.Column(db.String(80), unique=True, nullable=False)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)  # NULL = free
+    assigned_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint("coin", "network", "idx", name="uq_coin_network_idx"),
+        db.UniqueConstraint("user_id", "coin", "network", name="uq_user_coin_network"),
+    )
+
+
+class IncomingPayment(db.Model):
+    """Chain txids already turned into deposits by deposits.py (dedup for re-delivered payments)."""
+    id = db.Column(db.Integer, primary_key=True)
+    txid = db.Column(db.String(128), unique=True, nullable=False)
+    address = db.Column(db.String(80), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class LedgerSum(db.Model):
+    """Running sum of CONFIRMED Transaction amounts per (user, coin), kept by reconcile.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    coin = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "coin", name="uq_ledger_user_coin"),
+    )
+
+
+class LedgerCheckpoint(db.Model):
+    """High-water mark for reconcile.py (single row)."""
+    id = db.Column(db.Integer, primary_key=True)
+    last_tx_id = db.Column(db.Integer, nullable=False, default=0)
+    pending_ids = db.Column(db.Text, nullable=False, default="[]")  # JSON: PENDING ids <= last_tx_id
+    open_mismatches = db.Column(db.Text, nullable=False, default="[]")  # JSON: [user_id, coin] still mismatched
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class BalanceEvent(db.Model):
+    """Append-only balance journal (see journal.py). Asset rows are a projection of these."""
+    id = db.Column(db.Integer, primary_key=True)   # journal sequence number
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    coin = db.Column(db.String(20), nullable=False)
+
+    kind = db.Column(db.String(12), nullable=False)    # ADJUST / SET / OPENING
+    amount = db.Column(db.Float, nullable=False)       # as requested (delta for ADJUST, target for SET)
+    delta = db.Column(db.Float, nullable=False)        # resolved change to the balance
+    tx_id = db.Column(db.Integer, nullable=True)       # Transaction row written/confirmed with it
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class BalanceSnapshot(db.Model):
+    """Last BalanceEvent id reflected in the Asset projection (single row)."""
+    id = db.Column(db.Integer, primary_key=True)
+    last_event_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,38 @@
+"""
+Parallel per-user scans.
+
+Splits the user-id range of a table into one contiguous range per worker
+and runs a scan function over each range in a process pool. Used by the
+full reconciliation rescan and the journal replay.
+
+The scan runs in a separate process with its own engine. It is called as
+scan(db_url, lo, hi, *args) for user_id in [lo, hi) and must be a
+module-level function so it can be pickled.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from models import db
+
+
+def user_ranges(lo_uid, hi_uid, parts):
+    """Split [lo_uid, hi_uid] into at most `parts` half-open [lo, hi) ranges."""
+    parts = max(1, parts)
+    step = max(1, (hi_uid - lo_uid + 1 + parts - 1) // parts)
+    return [(lo, min(lo + step, hi_uid + 1)) for lo in range(lo_uid, hi_uid + 1, step)]
+
+
+def map_user_ranges(model, scan, *args, workers=4):
+    """
+    Run scan(db_url, lo, hi, *args) over the user ids present in `model`,
+    one range per worker. Returns the results in range order, or [] if the
+    table is empty. Needs an app context.
+    """
+    lo_uid, hi_uid = db.session.query(db.func.min(model.user_id), db.func.max(model.user_id)).one()
+    if lo_uid is None:
+        return []
+
+    ranges = user_ranges(lo_uid, hi_uid, workers)
+    db_url = db.engine.url.render_as_string(hide_password=False)
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(scan, db_url, lo, hi, *args) for lo, hi in ranges]
+        return [fut.result() for fut in futures]
@@ -0,0 +1,109 @@
+"""
+Write-behind persistence for the price cache.
+
+Callers mark the cache dirty instead of writing it. The first mark schedules
+a single flush `min_interval` seconds later, and every mark in between is
+coalesced into it, so the file is written at most once per interval no
+matter how often prices tick. The flush runs on a timer thread, off the
+request and streamer paths.
+
+Writes are atomic: the snapshot goes to a per-process temp file in the same
+directory, is fsynced, then os.replace()d over the target. Readers (and
+other workers racing on the same file) only ever see a complete snapshot.
+Each snapshot carries a format version and a CRC of its payload so load()
+can reject anything torn or hand-edited.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import zlib
+
+_FORMAT_VERSION = 1
+
+
+def _crc(payload):
+    return zlib.crc32(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode())
+
+
+class PriceCachePersister:
+    def __init__(self, path, snapshot, min_interval=5.0):
+        """
+        path:         target file
+        snapshot:     callable returning the dict to persist (read at flush time)
+        min_interval: minimum seconds between writes
+        """
+        self.path = path
+        self.snapshot = snapshot
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._timer = None
+        self._last_flush = 0.0
+        self._dirty = False
+        atexit.register(self.flush)
+
+    def mark_dirty(self):
+        """Schedule a flush unless one is already pending."""
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            delay = max(0.0, self._last_flush + self.min_interval - time.time())
+            self._timer = threading.Timer(delay, self._flush_scheduled)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_scheduled(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def flush(self):
+        """
+        Write the current snapshot atomically (temp file + fsync + rename),
+        if anything changed since the last write.
+        """
+        with self._lock:
+            if not self._dirty:
+                return False
+            self._dirty = False
+        try:
+            payload = self.snapshot()
+            doc = {"v": _FORMAT_VERSION, **payload, "crc": _crc(payload)}
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(doc, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._last_flush = time.time()
+            return True
+        except Exception:
+            with self._lock:
+                self._dirty = True
+            return False
+
+    def load(self):
+        """
+        Read and validate the snapshot.
+        Returns (payload, age_seconds), or (None, reason) if the file is
+        missing, unreadable, from another format version or fails its CRC.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+        except FileNotFoundError:
+            return None, "missing"
+        except (OSError, ValueError) as e:
+            return None, f"unreadable ({e.__class__.__name__})"
+
+        if not isinstance(doc, dict) or doc.get("v") != _FORMAT_VERSION:
+            return None, "unknown format"
+        crc = doc.pop("crc", None)
+        doc.pop("v", None)
+        if crc != _crc(doc):
+            return None, "checksum mismatch"
+        return doc, max(0.0, time.time() - float(doc.get("ts") or 0.0))
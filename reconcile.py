@@ -0,0 +1,347 @@
+"""
+Ledger reconciliation: Asset.amount should equal the sum of the user's
+CONFIRMED Transaction amounts for that coin.
+
+Instead of aggregating the whole Transaction table every time, running sums
+live in LedgerSum and a LedgerCheckpoint row records the highest
+Transaction.id already folded in. An incremental run only reads rows above
+that mark. PENDING rows at or below the mark are remembered in the
+checkpoint and picked up once they confirm. Pairs that failed the last
+comparison are remembered too and re-checked on every run until they match.
+
+A full rescan (first run, or after a repair) splits the user-id space into
+ranges and aggregates them in parallel in a process pool.
+
+Usage:
+    python reconcile.py              # incremental
+    python reconcile.py --full -j 4  # full parallel rescan
+"""
+import argparse
+import json
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Asset, Transaction, LedgerSum, LedgerCheckpoint
+from partition import map_user_ranges
+
+_TOLERANCE = 1e-8
+_BATCH_SIZE = 5000
+_SUSPECT_ROWS = 10
+
+
+def _key(user_id, coin):
+    return (user_id, (coin or "").upper())
+
+
+# -----------------------------
+# Checkpoint / sums storage
+# -----------------------------
+def _lock_checkpoint():
+    """
+    Return the checkpoint row with the write lock held until commit, so
+    concurrent runs (web request + CLI, several workers) are serialized.
+    The no-op UPDATE takes a row lock (or SQLite's RESERVED lock); the
+    checkpoint is read only after that, so a waiting run sees the result
+    of the run it waited for.
+    """
+    if not db.session.get(LedgerCheckpoint, 1):
+        try:
+            db.session.add(LedgerCheckpoint(id=1, last_tx_id=0, pending_ids="[]"))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+    db.session.execute(
+        update(LedgerCheckpoint)
+        .where(LedgerCheckpoint.id == 1)
+        .values(last_tx_id=LedgerCheckpoint.last_tx_id)
+    )
+    return db.session.get(LedgerCheckpoint, 1, populate_existing=True)
+
+
+def _load_sums(keys):
+    """{key: (LedgerSum id, total)} for `keys` only."""
+    sums = {}
+    keys = list(keys)
+    for i in range(0, len(keys), _BATCH_SIZE):
+        chunk = keys[i:i + _BATCH_SIZE]
+        wanted = set(chunk)
+        rows = db.session.query(
+            LedgerSum.id, LedgerSum.user_id, LedgerSum.coin, LedgerSum.total
+        ).filter(
+            LedgerSum.user_id.in_({k[0] for k in chunk}),
+            LedgerSum.coin.in_({k[1] for k in chunk}),
+        )
+        for row_id, user_id, coin, total in rows:
+            key = _key(user_id, coin)
+            if key in wanted:
+                sums[key] = (row_id, float(total))
+    return sums
+
+
+def _store_sums(sums, changed):
+    inserts, updates = [], []
+    for key in changed:
+        row_id, total = sums[key]
+        if row_id is None:
+            inserts.append({"user_id": key[0], "coin": key[1], "total": total})
+        else:
+            updates.append({"id": row_id, "total": total})
+    if inserts:
+        db.session.bulk_insert_mappings(LedgerSum, inserts)
+    if updates:
+        db.session.bulk_update_mappings(LedgerSum, updates)
+
+
+# -----------------------------
+# Incremental run
+# -----------------------------
+def run_incremental():
+    """
+    Fold every Transaction newer than the checkpoint (plus previously
+    PENDING rows that have since confirmed) into the running sums, advance
+    the checkpoint and return the mismatch report.
+
+    Only (user, coin) pairs touched since the last run are compared: those
+    with new transactions, Asset rows updated since the previous run, and
+    pairs still open from an earlier report.
+    """
+    started = datetime.utcnow()
+    cp = _lock_checkpoint()
+    prev_run = cp.updated_at if cp.last_tx_id else None
+    pending = set(json.loads(cp.pending_ids or "[]"))
+    still_open = {tuple(k) for k in json.loads(cp.open_mismatches or "[]")}
+    last_id = cp.last_tx_id or 0
+    deltas = {}
+    processed = 0
+
+    def fold(user_id, coin, amount):
+        key = _key(user_id, coin)
+        deltas[key] = deltas.get(key, 0.0) + float(amount)
+
+    # earlier PENDING rows that have confirmed since the last run
+    if pending:
+        ids = list(pending)
+        for i in range(0, len(ids), _BATCH_SIZE):
+            rows = db.session.query(
+                Transaction.id, Transaction.user_id, Transaction.coin,
+                Transaction.amount, Transaction.status,
+            ).filter(Transaction.id.in_(ids[i:i + _BATCH_SIZE])).all()
+            seen = set()
+            for tx_id, user_id, coin, amount, status in rows:
+                seen.add(tx_id)
+                if status == "CONFIRMED":
+                    fold(user_id, coin, amount)
+                    pending.discard(tx_id)
+                    processed += 1
+                elif status != "PENDING":
+                    pending.discard(tx_id)
+            # deleted rows
+            pending -= set(ids[i:i + _BATCH_SIZE]) - seen
+
+    # new rows since the checkpoint, in id order
+    while True:
+        rows = db.session.query(
+            Transaction.id, Transaction.user_id, Transaction.coin,
+            Transaction.amount, Transaction.status,
+        ).filter(Transaction.id > last_id).order_by(Transaction.id.asc()).limit(_BATCH_SIZE).all()
+        if not rows:
+            break
+        for tx_id, user_id, coin, amount, status in rows:
+            if status == "CONFIRMED":
+                fold(user_id, coin, amount)
+                processed += 1
+            elif status == "PENDING":
+                pending.add(tx_id)
+            last_id = tx_id
+
+    # balances changed without (or before) their transactions
+    assets = {}
+    query = db.session.query(Asset.user_id, Asset.coin, Asset.amount)
+    if prev_run is not None:
+        query = query.filter(Asset.updated_at > prev_run)
+    for user_id, coin, amount in query:
+        assets[_key(user_id, coin)] = float(amount)
+
+    keys = set(deltas) | set(assets) | still_open
+    sums = _load_sums(keys)
+    for key, delta in deltas.items():
+        row_id, total = sums.get(key, (None, 0.0))
+        sums[key] = (row_id, total + delta)
+    _store_sums(sums, deltas)
+
+    missing = [k for k in keys if k not in assets]
+    if missing:
+        for user_id, coin, amount in db.session.query(Asset.user_id, Asset.coin, Asset.amount).filter(
+            Asset.user_id.in_({k[0] for k in missing}),
+            Asset.coin.in_({k[1] for k in missing}),
+        ):
+            assets.setdefault(_key(user_id, coin), float(amount))
+
+    report = _compare(keys, {k: total for k, (_, total) in sums.items()}, assets)
+
+    cp.last_tx_id = last_id
+    cp.pending_ids = json.dumps(sorted(pending))
+    cp.open_mismatches = _open_keys(report)
+    cp.updated_at = started
+    db.session.commit()
+
+    report.update({"mode": "incremental", "processed": processed,
+                   "checkpoint": last_id, "pending": len(pending)})
+    return report
+
+
+# -----------------------------
+# Full parallel rescan
+# -----------------------------
+def _scan_range(db_url, lo, hi, max_tx_id):
+    """Worker: aggregate CONFIRMED amounts and collect PENDING ids for user_id in [lo, hi)."""
+    engine = create_engine(db_url)
+    t = Transaction.__table__
+    with engine.connect() as conn:
+        totals = conn.execute(
+            select(t.c.user_id, t.c.coin, func.sum(t.c.amount))
+            .where(t.c.user_id >= lo, t.c.user_id < hi,
+                   t.c.id <= max_tx_id, t.c.status == "CONFIRMED")
+            .group_by(t.c.user_id, t.c.coin)
+        ).all()
+        pending = conn.execute(
+            select(t.c.id)
+            .where(t.c.user_id >= lo, t.c.user_id < hi,
+                   t.c.id <= max_tx_id, t.c.status == "PENDING")
+        ).scalars().all()
+    engine.dispose()
+    return [(u, c, float(s or 0)) for u, c, s in totals], list(pending)
+
+
+def run_full(workers=4):
+    """
+    Rebuild LedgerSum from scratch by aggregating user-id ranges in a
+    process pool, reset the checkpoint to the highest id scanned and
+    return the mismatch report.
+    """
+    started = datetime.utcnow()
+    cp = _lock_checkpoint()
+    max_tx_id = db.session.query(func.max(Transaction.id)).scalar() or 0
+
+    sums = {}
+    pending = []
+    if max_tx_id:
+        for totals, pend in map_user_ranges(Transaction, _scan_range, max_tx_id, workers=workers):
+            for user_id, coin, total in totals:
+                key = _key(user_id, coin)
+                sums[key] = sums.get(key, 0.0) + total
+            pending.extend(pend)
+
+    LedgerSum.query.delete()
+    db.session.bulk_insert_mappings(LedgerSum, [
+        {"user_id": user_id, "coin": coin, "total": total}
+        for (user_id, coin), total in sums.items()
+    ])
+    report = find_mismatches(sums)
+
+    cp.last_tx_id = max_tx_id
+    cp.pending_ids = json.dumps(sorted(pending))
+    cp.open_mismatches = _open_keys(report)
+    cp.updated_at = started
+    db.session.commit()
+
+    report.update({"mode": "full", "workers": workers,
+                   "checkpoint": max_tx_id, "pending": len(pending)})
+    return report
+
+
+# -----------------------------
+# Mismatch report
+# -----------------------------
+def _suspect_dict(t, reason):
+    return {"tx_id": t.id, "type": t.type, "amount": float(t.amount),
+            "note": t.note or "", "reason": reason,
+            "created_at": t.created_at.isoformat() + "Z"}
+
+
+def _suspect_rows(user_id, coin, diff):
+    """
+    Transactions most likely to explain a mismatch: "set balance" rows that
+    logged an absolute amount instead of a delta, and single rows whose
+    amount matches the difference. Falls back to the latest rows.
+    At most _SUSPECT_ROWS rows are read per query.
+    """
+    base = (
+        Transaction.query
+        .filter_by(user_id=user_id, coin=coin, status="CONFIRMED")
+        .order_by(Transaction.id.desc())
+    )
+    suspects = [
+        _suspect_dict(t, "absolute amount logged as delta")
+        for t in base.filter(or_(
+            func.upper(Transaction.type) == "ADMIN_SET",
+            func.lower(Transaction.note).like("admin set balance%"),
+        )).limit(_SUSPECT_ROWS)
+    ]
+    if len(suspects) < _SUSPECT_ROWS:
+        suspects += [
+            _suspect_dict(t, "amount equals difference")
+            for t in base.filter(
+                func.abs(func.abs(Transaction.amount) - abs(diff)) <= _TOLERANCE,
+                Transaction.id.notin_([s["tx_id"] for s in suspects]),
+            ).limit(_SUSPECT_ROWS - len(suspects))
+        ]
+    if not suspects:
+        suspects = [_suspect_dict(t, "recent") for t in base.limit(_SUSPECT_ROWS)]
+    return suspects
+
+
+def _compare(keys, sums, assets):
+    """Mismatch report for `keys`, given ledger `sums` and `assets` amounts (missing = 0)."""
+    mismatches = []
+    for key in keys:
+        amount = assets.get(key, 0.0)
+        expected = sums.get(key, 0.0)
+        if abs(amount - expected) > _TOLERANCE:
+            mismatches.append((key, amount, expected))
+    mismatches.sort()
+
+    return {
+        "mismatches": [
+            {"user_id": user_id, "coin": coin, "asset_amount": amount,
+             "ledger_sum": expected, "diff": amount - expected,
+             "suspects": _suspect_rows(user_id, coin, amount - expected)}
+            for (user_id, coin), amount, expected in mismatches
+        ]
+    }
+
+
+def _open_keys(report):
+    """JSON list of the [user_id, coin] pairs in `report`, for the checkpoint."""
+    return json.dumps([[m["user_id"], m["coin"]] for m in report["mismatches"]])
+
+
+def find_mismatches(sums):
+    """Compare every Asset row (and every ledger sum without one) against `sums`."""
+    assets = {
+        _key(user_id, coin): float(amount)
+        for user_id, coin, amount in db.session.query(Asset.user_id, Asset.coin, Asset.amount)
+    }
+    return _compare(set(assets) | set(sums), sums, assets)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile Asset balances against Transaction history.")
+    parser.add_argument("--full", action="store_true", help="full parallel rescan instead of incremental")
+    parser.add_argument("-j", "--workers", type=int, default=4, help="processes for --full")
+    args = parser.parse_args()
+
+    from app import app
+
+    with app.app_context():
+        db.create_all()
+        report = run_full(args.workers) if args.full else run_incremental()
+
+    for m in report["mismatches"]:
+        print(f"user {m['user_id']} {m['coin']}: asset={m['asset_amount']} ledger={m['ledger_sum']} diff={m['diff']}")
+        for s in m["suspects"]:
+            print(f"    tx {s['tx_id']} {s['type']} {s['amount']} ({s['reason']}) {s['note']}")
+    print(f"{report['mode']}: checkpoint={report['checkpoint']} pending={report['pending']} "
+          f"mismatches={len(report['mismatches'])}")
@@ -0,0 +1,84 @@
+"""
+Multi-currency valuation.
+
+Every cross rate we need is price_usd[asset] / usd_per_unit[quote], so the
+asset x quote price matrix is the outer product of two vectors and is never
+materialised. The quote rates come from the same batched /simple/price
+calls that fetch USD prices (vs_currencies=usd,cad,eur), so valuing a
+portfolio in another currency costs no extra upstream requests; it is one
+pass of amount x column over the holdings.
+
+Fiat held as an asset (e.g. CAD) is priced through the same rates, so a
+CAD balance is worth usd_per_unit["CAD"] USD, not 1.0.
+"""
+from statistics import median
+
+import coins as registry
+
+
+def quote_rates_from_quotes(quotes):
+    """
+    Derive USD per unit of each quote currency from upstream
+    {symbol: {"usd": .., "cad": .., ...}} rows: for every coin priced in both
+    USD and the quote, usd/quote is one estimate; take the median.
+    """
+    rates = {"USD": 1.0}
+    for q in registry.QUOTE_CURRENCIES:
+        if q == "USD":
+            continue
+        key = q.lower()
+        samples = [
+            row["usd"] / row[key]
+            for row in quotes.values()
+            if row.get("usd") and row.get(key)
+        ]
+        if samples:
+            rates[q] = float(median(samples))
+    return rates
+
+
+class FxMatrix:
+    def __init__(self, usd_prices, quote_usd, ts=0.0):
+        self.ts = ts
+        self.usd = dict(registry.fallback_prices())
+        self.usd.update({k: float(v) for k, v in (usd_prices or {}).items() if v})
+        self.quote_usd = dict(registry.QUOTE_CURRENCIES)
+        self.quote_usd.update({k: float(v) for k, v in (quote_usd or {}).items() if v})
+        # fiat assets are priced by their own quote rate
+        for q, rate in self.quote_usd.items():
+            self.usd[q] = rate
+        self._columns = {}
+
+    def column(self, quote):
+        """Price of every known asset in `quote`, computed once per snapshot."""
+        quote = quote.upper()
+        col = self._columns.get(quote)
+        if col is None:
+            inv = 1.0 / self.quote_usd[quote]
+            col = {sym: px * inv for sym, px in self.usd.items()}
+            self._columns[quote] = col
+        return col
+
+    def value(self, holdings, quote="USD"):
+        """
+        holdings: iterable of (symbol, amount).
+        Returns ([value per holding], total) in `quote`.
+        """
+        col = self.column(quote)
+        values = [float(amount) * col.get(sym.upper(), 0.0) for sym, amount in holdings]
+        return values, sum(values)
+
+
+_matrix = {"key": None, "fx": None}
+
+
+def get_matrix(price_cache):
+    """
+    FxMatrix for the current price cache snapshot. Rebuilt only when the
+    cache timestamp changes, so request handlers share the cached columns.
+    """
+    key = (price_cache.get("ts"), len(price_cache.get("prices") or {}))
+    if _matrix["key"] != key or _matrix["fx"] is None:
+        _matrix["fx"] = FxMatrix(price_cache.get("prices"), price_cache.get("fx"), price_cache.get("ts") or 0.0)
+        _matrix["key"] = key
+    return _matrix["fx"]